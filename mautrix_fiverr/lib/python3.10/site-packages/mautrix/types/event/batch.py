@@ -13,7 +13,7 @@ from ..util import SerializableAttrs
 from .base import BaseEvent
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class BatchSendEvent(BaseEvent, SerializableAttrs):
     """Base event class for events sent via a batch send request."""
 
@@ -24,7 +24,7 @@ class BatchSendEvent(BaseEvent, SerializableAttrs):
     event_id: Optional[EventID] = None
 
 
-@dataclass(kw_only=True)
+@dataclass(kw_only=True, slots=True)
 class BatchSendStateEvent(BatchSendEvent, SerializableAttrs):
     """
     State events to be used as initial state events on batch send events. These never need to be
@@ -9,7 +9,7 @@ from .errors import (
     UnsupportedDatabaseVersion,
 )
 from .scheme import Scheme
-from .upgrade import UpgradeTable, register_upgrade
+from .upgrade import UpgradeTable, add_bool_columns, register_upgrade
 
 try:
     from .asyncpg import PostgresDatabase
@@ -32,6 +32,7 @@ __all__ = [
     "Database",
     "UpgradeTable",
     "register_upgrade",
+    "add_bool_columns",
     "PostgresDatabase",
     "SQLiteDatabase",
     "SQLiteCursor",
@@ -6,10 +6,14 @@
 from __future__ import annotations
 
 from typing import Awaitable, Callable, Optional, cast
+import asyncio
 import functools
 import inspect
+import itertools
 import logging
+import time
 
+from mautrix import __optional_imports__
 from mautrix.util.logging import TraceLogger
 
 from .. import async_db
@@ -17,17 +21,58 @@ from .connection import LoggingConnection
 from .errors import UnsupportedDatabaseVersion
 from .scheme import Scheme
 
+if __optional_imports__:
+    from asyncpg.prepared_stmt import PreparedStatement
+
 Upgrade = Callable[[LoggingConnection, Scheme], Awaitable[Optional[int]]]
 UpgradeWithoutScheme = Callable[[LoggingConnection], Awaitable[Optional[int]]]
+# (upgrade, destination version, description, wrap in transaction, parallel group)
+RegisteredUpgrade = tuple[Upgrade, "int | Upgrade | None", str, bool, "int | None"]
 
 
 async def noop_upgrade(_: LoggingConnection, _2: Scheme) -> None:
     pass
 
 
+_noop_entry: RegisteredUpgrade = (noop_upgrade, None, "", True, None)
+
+
+# Schema versions seen by this process, keyed by (database URL, version table name).
+# Lets warm restarts skip the version table queries entirely when the database is
+# already known to be at the latest version.
+_version_cache: dict[tuple[str, str], tuple[int, float]] = {}
+_version_cache_ttl = 30.0
+
+
+async def add_bool_columns(
+    conn: LoggingConnection, table: str, *cols: str, default: bool = False
+) -> None:
+    """
+    Add boolean columns to a table in as few round trips as the dialect allows:
+    a single multi-ADD ``ALTER TABLE`` on Postgres, one statement per column on
+    SQLite (which only supports one ADD COLUMN per ALTER TABLE).
+    """
+    default_sql = "true" if default else "false"
+    if conn.scheme != Scheme.SQLITE:
+        clauses = ", ".join(
+            f"ADD COLUMN {col} BOOLEAN NOT NULL DEFAULT {default_sql}" for col in cols
+        )
+        await conn.execute(f"ALTER TABLE {table} {clauses}")
+    else:
+        for col in cols:
+            await conn.execute(
+                f"ALTER TABLE {table} ADD COLUMN {col} BOOLEAN NOT NULL DEFAULT {default_sql}"
+            )
+
+
 def _wrap_upgrade(fn: UpgradeWithoutScheme | Upgrade) -> Upgrade:
-    params = inspect.signature(fn).parameters
-    if len(params) == 1:
+    try:
+        # Much cheaper than inspect.signature, which builds a Parameter object
+        # per argument every time an upgrade is registered.
+        argcount = inspect.unwrap(fn).__code__.co_argcount
+    except AttributeError:
+        argcount = len(inspect.signature(fn).parameters)
+    if argcount == 1:
         _wrapped: UpgradeWithoutScheme = cast(UpgradeWithoutScheme, fn)
 
         @functools.wraps(_wrapped)
@@ -40,11 +85,21 @@ def _wrap_upgrade(fn: UpgradeWithoutScheme | Upgrade) -> Upgrade:
 
 
 class UpgradeTable:
-    upgrades: list[Upgrade]
+    __slots__ = (
+        "upgrades",
+        "allow_unsupported",
+        "database_name",
+        "version_table_name",
+        "log",
+        "_save_stmt",
+    )
+
+    upgrades: list[RegisteredUpgrade]
     allow_unsupported: bool
     database_name: str
     version_table_name: str
     log: TraceLogger
+    _save_stmt: Optional["PreparedStatement"]
 
     def __init__(
         self,
@@ -54,6 +109,7 @@ class UpgradeTable:
         log: logging.Logger | TraceLogger | None = None,
     ) -> None:
         self.upgrades = []
+        self._save_stmt = None
         self.allow_unsupported = allow_unsupported
         self.version_table_name = version_table_name
         self.database_name = database_name
@@ -67,6 +123,7 @@ class UpgradeTable:
         description: str = "",
         transaction: bool = True,
         upgrades_to: int | Upgrade | None = None,
+        parallel_group: int | None = None,
     ) -> Upgrade | Callable[[Upgrade | UpgradeWithoutScheme], Upgrade]:
         if isinstance(index, str):
             description = index
@@ -74,29 +131,138 @@ class UpgradeTable:
 
         def actually_register(fn: Upgrade | UpgradeWithoutScheme) -> Upgrade:
             fn = _wrap_upgrade(fn)
-            fn.__mau_db_upgrade_description__ = description
-            fn.__mau_db_upgrade_transaction__ = transaction
-            fn.__mau_db_upgrade_destination__ = (
+            destination = (
                 upgrades_to
                 if not upgrades_to or isinstance(upgrades_to, int)
                 else _wrap_upgrade(upgrades_to)
             )
+            entry = (fn, destination, description, transaction, parallel_group)
             if index == -1 or index == len(self.upgrades):
-                self.upgrades.append(fn)
+                self.upgrades.append(entry)
             else:
                 if len(self.upgrades) <= index:
-                    self.upgrades += [noop_upgrade] * (index - len(self.upgrades) + 1)
-                self.upgrades[index] = fn
+                    self.upgrades.extend(
+                        itertools.repeat(_noop_entry, index - len(self.upgrades) + 1)
+                    )
+                self.upgrades[index] = entry
             return fn
 
         return actually_register(_outer_fn) if _outer_fn else actually_register
 
+    async def _run_migration(
+        self, db: async_db.Database, conn: LoggingConnection, version: int
+    ) -> int:
+        # Runs a single migration and saves the new version, without opening a
+        # transaction: the caller decides how migrations share transactions.
+        old_version = version
+        upgrade, new_version, desc, _, _ = self.upgrades[version]
+        if not new_version:
+            new_version = version + 1
+        elif callable(new_version):
+            new_version = await new_version(conn, db.scheme)
+        suffix = f": {desc}" if desc else ""
+        self.log.debug(
+            f"Upgrading {self.database_name} from v{old_version} to v{new_version}{suffix}"
+        )
+        version = await upgrade(conn, db.scheme) or new_version
+        await self._save_version(conn, version)
+        if version != new_version:
+            self.log.warning(
+                f"Upgrading {self.database_name} actually went from v{old_version} "
+                f"to v{version}"
+            )
+        return version
+
+    async def _run_parallel_group(
+        self, db: async_db.Database, conn: LoggingConnection, version: int, group: int
+    ) -> int:
+        # Consecutive upgrades registered with the same parallel_group are declared
+        # independent, so run each on its own pooled connection and bump the version
+        # once after they all finish.
+        end = version
+        while end < len(self.upgrades) and self.upgrades[end][4] == group:
+            end += 1
+        entries = self.upgrades[version:end]
+        descs = ", ".join(desc for _, _, desc, _, _ in entries if desc)
+        suffix = f": {descs}" if descs else ""
+        self.log.debug(
+            f"Upgrading {self.database_name} from v{version} to v{end} "
+            f"({len(entries)} parallel upgrades{suffix})"
+        )
+
+        async def _run_one(upgrade: Upgrade, transactional: bool) -> None:
+            async with db.acquire() as group_conn:
+                if transactional:
+                    async with group_conn.transaction():
+                        await upgrade(group_conn, db.scheme)
+                else:
+                    await upgrade(group_conn, db.scheme)
+
+        if db.scheme == Scheme.SQLITE:
+            # The SQLite pool usually has a single connection, which the caller is
+            # already holding, so acquiring more would deadlock. Run serially there.
+            for upgrade, _, _, transaction, _ in entries:
+                if transaction:
+                    async with conn.transaction():
+                        await upgrade(conn, db.scheme)
+                else:
+                    await upgrade(conn, db.scheme)
+        else:
+            await asyncio.gather(
+                *(
+                    _run_one(upgrade, transaction)
+                    for upgrade, _, _, transaction, _ in entries
+                )
+            )
+        await self._save_version(conn, end)
+        return end
+
+    async def _ensure_version_id_column(self, conn: LoggingConnection) -> None:
+        # The version table used to be keyed on the version value itself, which
+        # forced a DELETE before every INSERT. A fixed-key sentinel column lets
+        # the save be a single upsert; tables from older versions of this module
+        # get the column added here. Only runs when migrations actually run.
+        table = self.version_table_name
+        if conn.scheme != Scheme.SQLITE:
+            await conn.execute(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS id INTEGER NOT NULL DEFAULT 1; "
+                f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_id_idx ON {table} (id);"
+            )
+        else:
+            cols = await conn.fetch(f"PRAGMA table_info({table})")
+            if not any(col["name"] == "id" for col in cols):
+                await conn.execute(
+                    f"ALTER TABLE {table} ADD COLUMN id INTEGER NOT NULL DEFAULT 1"
+                )
+            await conn.execute(
+                f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_id_idx ON {table} (id)"
+            )
+
+    def _save_version_query(self) -> str:
+        return (
+            f"INSERT INTO {self.version_table_name} (id, version) VALUES (1, $1) "
+            f"ON CONFLICT (id) DO UPDATE SET version=excluded.version"
+        )
+
     async def _save_version(self, conn: LoggingConnection, version: int) -> None:
         self.log.trace(f"Saving current version (v{version}) to database")
-        await conn.execute(f"DELETE FROM {self.version_table_name}")
-        await conn.execute(f"INSERT INTO {self.version_table_name} (version) VALUES ($1)", version)
+        if self._save_stmt is not None:
+            # Prepared once per upgrade run, so each save is a single Bind/Execute
+            # round trip with no re-parse.
+            await self._save_stmt.fetch(version)
+        else:
+            await conn.execute(self._save_version_query(), version)
 
     async def upgrade(self, db: async_db.Database) -> None:
+        cache_key = (str(db.url), self.version_table_name)
+        cached = _version_cache.get(cache_key)
+        if (
+            cached
+            and cached[0] == len(self.upgrades)
+            and time.monotonic() - cached[1] < _version_cache_ttl
+        ):
+            self.log.debug(f"Database at v{cached[0]} (cached), not upgrading")
+            return
         await db.execute(
             f"""CREATE TABLE IF NOT EXISTS {self.version_table_name} (
                 version INTEGER PRIMARY KEY
@@ -116,41 +282,78 @@ class UpgradeTable:
                 return
         elif len(self.upgrades) == version:
             self.log.debug(f"Database at v{version}, not upgrading")
+            _version_cache[cache_key] = (version, time.monotonic())
             return
 
+        _version_cache.pop(cache_key, None)
         async with db.acquire() as conn:
-            while version < len(self.upgrades):
-                old_version = version
-                upgrade = self.upgrades[version]
-                new_version = (
-                    getattr(upgrade, "__mau_db_upgrade_destination__", None) or version + 1
+            locked = False
+            if conn.scheme == Scheme.POSTGRES:
+                # Serialize concurrently booting instances: only one runs the
+                # migrations, the rest wait here instead of crashing on duplicate
+                # DDL. Session-level, so it's also released if the connection dies.
+                await conn.fetchval(
+                    "SELECT pg_advisory_lock(hashtext($1))", self.database_name
                 )
-                if callable(new_version):
-                    new_version = await new_version(conn, db.scheme)
-                desc = getattr(upgrade, "__mau_db_upgrade_description__", None)
-                suffix = f": {desc}" if desc else ""
-                self.log.debug(
-                    f"Upgrading {self.database_name} from v{old_version} to v{new_version}{suffix}"
+                locked = True
+                # Another instance may have upgraded while we waited for the lock.
+                row = await conn.fetchrow(
+                    f"SELECT version FROM {self.version_table_name} LIMIT 1"
                 )
-                if getattr(upgrade, "__mau_db_upgrade_transaction__", True):
-                    async with conn.transaction():
-                        version = await upgrade(conn, db.scheme) or new_version
-                        await self._save_version(conn, version)
-                else:
-                    version = await upgrade(conn, db.scheme) or new_version
-                    await self._save_version(conn, version)
-                if version != new_version:
-                    self.log.warning(
-                        f"Upgrading {self.database_name} actually went from v{old_version} "
-                        f"to v{version}"
+                version = row["version"] if row else 0
+                if len(self.upgrades) <= version:
+                    self.log.debug(f"Database at v{version}, not upgrading")
+                    _version_cache[cache_key] = (version, time.monotonic())
+                    await conn.fetchval(
+                        "SELECT pg_advisory_unlock(hashtext($1))", self.database_name
                     )
+                    return
+            await self._ensure_version_id_column(conn)
+            if conn.scheme != Scheme.SQLITE:
+                # Preparing the upsert up front skips Parse+Describe on every
+                # migration's version save.
+                self._save_stmt = await conn.wrapped.prepare(self._save_version_query())
+            try:
+                while version < len(self.upgrades):
+                    transaction = self.upgrades[version][3]
+                    group = self.upgrades[version][4]
+                    if group is not None:
+                        version = await self._run_parallel_group(db, conn, version, group)
+                        continue
+                    if transaction:
+                        # Coalesce the run of consecutive transactional migrations
+                        # into one BEGIN/COMMIT instead of paying a transaction per
+                        # migration. A failure rolls the whole run back to the
+                        # version recorded before it started.
+                        end = version
+                        while (
+                            end < len(self.upgrades)
+                            and self.upgrades[end][3]
+                            and self.upgrades[end][4] is None
+                        ):
+                            end += 1
+                        async with conn.transaction():
+                            while version < end:
+                                version = await self._run_migration(db, conn, version)
+                    else:
+                        version = await self._run_migration(db, conn, version)
+            finally:
+                self._save_stmt = None
+                if locked:
+                    await conn.fetchval(
+                        "SELECT pg_advisory_unlock(hashtext($1))", self.database_name
+                    )
+        _version_cache[cache_key] = (version, time.monotonic())
 
 
 upgrade_tables: dict[str, UpgradeTable] = {}
+_upgrade_table_module_cache: dict[str, UpgradeTable] = {}
 
 
 def register_upgrade_table_parent_module(name: str) -> None:
     upgrade_tables[name] = UpgradeTable()
+    # A new parent module may be a better match for already-cached child modules.
+    _upgrade_table_module_cache.clear()
 
 
 def _find_upgrade_table(fn: Upgrade) -> UpgradeTable:
@@ -161,15 +364,22 @@ def _find_upgrade_table(fn: Upgrade) -> UpgradeTable:
             "Registering upgrades without an UpgradeTable requires the function "
             "to have the __module__ attribute."
         ) from e
+    try:
+        return _upgrade_table_module_cache[module]
+    except KeyError:
+        pass
     parts = module.split(".")
     used_parts = []
     last_error = None
     for part in parts:
         used_parts.append(part)
         try:
-            return upgrade_tables[".".join(used_parts)]
+            table = upgrade_tables[".".join(used_parts)]
         except KeyError as e:
             last_error = e
+        else:
+            _upgrade_table_module_cache[module] = table
+            return table
     raise KeyError(
         "Registering upgrades without an UpgradeTable requires you to register a parent "
         "module with register_upgrade_table_parent_module first."
@@ -6,15 +6,30 @@
 from __future__ import annotations
 
 from typing import Generic, TypeVar
+import re
 
 T = TypeVar("T")
 
 
 class SimpleTemplate(Generic[T]):
+    __slots__ = (
+        "_template",
+        "_keyword",
+        "_template_prefix",
+        "_template_suffix",
+        "_prefix",
+        "_suffix",
+        "_parse_re",
+        "_type",
+    )
+
     _template: str
     _keyword: str
+    _template_prefix: str
+    _template_suffix: str
     _prefix: str
     _suffix: str
+    _parse_re: re.Pattern[str]
     _type: type[T]
 
     def __init__(
@@ -24,25 +39,26 @@ class SimpleTemplate(Generic[T]):
         self._keyword = keyword
         index = self._template.find("{%s}" % keyword)
         length = len(keyword) + 2
-        self._prefix = prefix + self._template[:index]
-        self._suffix = self._template[index + length :] + suffix
+        self._template_prefix = self._template[:index]
+        self._template_suffix = self._template[index + length :]
+        self._prefix = prefix + self._template_prefix
+        self._suffix = self._template_suffix + suffix
+        self._parse_re = re.compile(
+            re.escape(self._prefix) + "(.*)" + re.escape(self._suffix) + r"\Z", re.DOTALL
+        )
         self._type = type
 
     def format(self, arg: T) -> str:
-        return self._template.format(**{self._keyword: arg})
+        return f"{self._template_prefix}{arg}{self._template_suffix}"
 
     def format_full(self, arg: T) -> str:
         return f"{self._prefix}{arg}{self._suffix}"
 
     def parse(self, val: str) -> T | None:
-        prefix_ok = val[: len(self._prefix)] == self._prefix
-        has_suffix = len(self._suffix) > 0
-        suffix_ok = not has_suffix or val[-len(self._suffix) :] == self._suffix
-        if prefix_ok and suffix_ok:
-            start = len(self._prefix)
-            end = -len(self._suffix) if has_suffix else len(val)
+        match = self._parse_re.match(val)
+        if match:
             try:
-                return self._type(val[start:end])
+                return self._type(match.group(1))
             except ValueError:
                 pass
         return None